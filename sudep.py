@@ -6,6 +6,10 @@ public incase additional functionallity is desired. It may also be beneficial to
 view the help for classes User, Session, and Profile to better understand how
 the data is structured.
 
+user_list is downloaded the first time it is accessed, so it is left out of
+__all__; use sudep.user_list (or from sudep import user_list) to get it. A
+wildcard import would otherwise download it when sudep is imported.
+
 Example 3: Viewing a summary of all of user's collected data.
     >>> SM8 = get_user(user_list[7])
     >>> print(SM8)
@@ -39,35 +43,85 @@ Note: The data from Example 3 can be obtained much more succinctly using:
 
 """
 
-__all__ = ['user_list','get_user','save','load','User','Session','Profile',
+__all__ = ['get_user','save','load','User','Session','Profile',
            'get_events_for','get_profile_for','get_session_dates_for',
-           'get_session_for','plot']
+           'get_session_for','plot','downsample']
 
 __version__ = '0.1'
 __author__ = 'David Connell'
 
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
+from tsdownsample import MinMaxLTTBDownsampler
 import numpy as np
-import cPickle
+import pickle
 import os
+import time
+import functools
+from collections.abc import Mapping
 
 ### Download from database ###
 base_url = 'https://sudepmonitor.firebaseio.com/'
+max_workers = 16
+user_list_path = 'Users/_user_list.json'
+user_list_max_age = 3600    # Seconds before the saved user list is refetched.
+max_plot_points = 4000      # Signals longer than this are downsampled to
+                            # plot_points before being plotted.
+plot_points = 2000
+
+# One pooled session so repeated downloads reuse the same TLS connections.
+_HTTP = requests.Session()
+_HTTP.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
 
 def get_user_list():
     url = base_url + 'UserList.json'
     return download_json_data_from(url)
 
 def download_json_data_from(url):
-    json_data = requests.get(url)
+    json_data = _HTTP.get(url, timeout=10).content
+
+    if not json_data:
+        return {}
 
-    if json_data.json() == None:
+    json_data = orjson.loads(json_data)
+    if json_data == None:
         return {}
 
-    return json_data.json()
+    return json_data
+
+_user_list = None
+
+def __getattr__(name):
+    """ Fetches user_list on first access rather than when sudep is imported. """
 
-user_list = get_user_list()
+    if name == 'user_list':
+        return _get_user_list()
+    raise AttributeError('module %r has no attribute %r' %(__name__,name))
+
+def _get_user_list(reload=False):
+    global _user_list
+    if _user_list is None or reload:
+        _user_list = _load_or_fetch_user_list(reload)
+    return _user_list
+
+def _load_or_fetch_user_list(reload=False):
+    """ Reads the user list saved in Users if it is younger than
+    user_list_max_age, otherwise downloads it and saves it there. """
+
+    if not reload and os.path.exists(user_list_path):
+        age = time.time() - os.path.getmtime(user_list_path)
+        if age < user_list_max_age:
+            with open(user_list_path, 'rb') as file:
+                return orjson.loads(file.read())
+
+    user_list = get_user_list()
+    _look_for_and_create_users_folder()
+    with open(user_list_path, 'wb') as file:
+        file.write(orjson.dumps(user_list))
+    return user_list
 
 ### Get user ###
 def get_user(user_name, reload=False):
@@ -78,11 +132,14 @@ def get_user(user_name, reload=False):
 
     _look_for_and_create_users_folder()
 
+    if reload:
+        _clear_download_caches()
+
     if _is_file_in_directory(user_name) and not reload:
         return(load(user_name))
 
-    elif user_name in user_list:
-        user = User(user_name)
+    elif user_name in _get_user_list(reload):
+        user = User(user_name,lazy=False)
         save(user)
         return(user)
 
@@ -90,6 +147,10 @@ def get_user(user_name, reload=False):
         print('%s does not exist in the database' %user_name)
         return
 
+def _clear_download_caches():
+    _download_session_dates_for.cache_clear()
+    _download_profile_for.cache_clear()
+
 def _look_for_and_create_users_folder():
     """ Looks for the folder "Users" in the current directory and makes it
     if it does not exist. """
@@ -125,16 +186,18 @@ def save(user,update=True):
         if _is_file_in_directory(user.user_name):
             return
 
-    file = open(file_path, 'wb')
-    cPickle.dump(user,file,protocol=2)
+    with open(file_path, 'wb') as file:
+        pickle.dump(user,file,protocol=pickle.HIGHEST_PROTOCOL)
 
 def load(user_name):
     """ loads previously saved files. Files are saved as the user_name (UserID).
     Input user_name should be a string. """
 
     file_path = 'Users/' + user_name + '.pkl'
-    file = open(file_path, 'rb')
-    return(cPickle.load(file))
+    # latin1 lets Python 3 read the NumPy arrays in users saved by the
+    # Python 2 cPickle version of this module.
+    with open(file_path, 'rb') as file:
+        return(pickle.load(file,encoding='latin1'))
 
 ### Data structures ###
 class User:
@@ -144,8 +207,11 @@ class User:
     .sessions, and .dates. Print User to see a summary of all the user's
     information.
 
-    .profile is of type custom class Profile and .sessions is a dictionary of
-    type custom class Session. See Profile and Session for more information.
+    .profile is of type custom class Profile and .sessions is a dictionary-like
+    mapping of type custom class Session. See Profile and Session for more
+    information. By default each session is only downloaded the first time it
+    is accessed. User(user_name,lazy=False) instead downloads all of the
+    user's data in a single request.
 
     .events is a dictionary containing all the user's events with the dates of
     the events as the keys.
@@ -157,18 +223,35 @@ class User:
         first_session = SM18.sessions(SM18.dates[0])
 
     Which returns a session dictionary described by the custom class Session.
-    However, all the data for the user is downloaded from the database everytime
+    However, the data for the user is downloaded from the database everytime
     User() is called. To reduce the number time consuming downloads it is
     suggested to get instances of User through the function get_user(user_name)
     instead which, manages saving and loading user data to and from a local
     drive. """
 
-    def __init__(self,name):
+    def __init__(self,name,lazy=True):
         self.user_name = name
+
+        if lazy:
+            self._download_metadata_for(name)
+        else:
+            self._download_everything_for(name)
+
+    def _download_metadata_for(self,name):
         self.profile = Profile(name)
-        self.events = get_events_for(name,event_type=True)
-        self.sessions = get_session_for(name)
         self.dates = get_session_dates_for(name)
+        self.sessions = _LazySessions(name,self.dates)
+        self.events = get_events_for(name,event_type=True)
+
+    def _download_everything_for(self,name):
+        user_data = _download_user(name)
+        meta_data = user_data.pop('MetaData',{})
+
+        self.profile = Profile(name,profile=meta_data.get('Profile',{}))
+        self.dates = _date_sort(user_data.keys())
+        sessions = _sessions_from(user_data)
+        self.sessions = _LazySessions(name,self.dates,sessions=sessions)
+        self.events = meta_data.get('Events') or {}
 
     def __str__(self):
         user_name = 'User Name: %s \n' %(self.user_name)
@@ -191,12 +274,20 @@ class User:
     def _session_string(self):
         string = ""
         keys = _date_sort(self.sessions.keys())
+        durations = self._durations()
         for key in keys:
-            duration = self._ss_to_hhmmss(self.sessions[key].duration)
+            duration = self._ss_to_hhmmss(durations[key])
             lexed_session = _lex(key)
             string += '\t %s || %s \n' %(lexed_session,duration)
         return('Sessions (date (dd.MM.yy hh:mm:ss) || duration): \n' + string + '\n')
 
+    def _durations(self):
+        # Users pickled before sessions were loaded lazily hold a plain dict.
+        if isinstance(self.sessions,_LazySessions):
+            return self.sessions.durations()
+        return dict((date,session.duration)
+                    for date,session in self.sessions.items())
+
     def _ss_to_hhmmss(self,time_in_secs):
         hours = float(time_in_secs)/3600.0
         mins = hours - int(hours)
@@ -211,8 +302,10 @@ class User:
 class Profile:
     """ A class for presenting the profile data for a user. """
 
-    def __init__(self,name):
-        profile = get_profile_for(str(name))
+    def __init__(self,name,profile=None):
+        if profile is None:
+            profile = get_profile_for(str(name))
+
         self.dob = profile['Date of Birth']
         self.gender = profile['Gender']
         self.height = profile['Height (m)']
@@ -234,26 +327,29 @@ def get_profile_for(user_list):
     list of users, or 'all' to return all profiles on database. """
 
     if user_list == 'all':
-        user_list = globals()['user_list']
+        user_list = _get_user_list()
 
     elif type(user_list) == str:
         user = user_list
         return _get_individual_profile_for(user)
 
-    profiles = {}
-    for user in user_list:
-        profiles[user] = _get_individual_profile_for(user)
-
-    return profiles
+    with ThreadPoolExecutor(max_workers) as executor:
+        profiles = executor.map(_get_individual_profile_for, user_list)
+        return dict(zip(user_list, profiles))
 
 def _get_individual_profile_for(user):
+    return dict(_download_profile_for(user))
+
+@functools.lru_cache(maxsize=None)
+def _download_profile_for(user):
+    # Cached as a tuple of items so callers cannot change the cached profile.
     url = base_url + user + '/MetaData/Profile.json'
     profile = download_json_data_from(url)
 
     if profile == None:
-        return {}
+        return ()
 
-    return profile
+    return tuple(profile.items())
 
 
 def get_events_for(user, event_type=False):
@@ -302,9 +398,9 @@ class Session:
         else:
             return 'Empty'
 
-        x = np.array(accel['x'])
-        y = np.array(accel['y'])
-        z = np.array(accel['z'])
+        x = _as_f32(accel['x'])
+        y = _as_f32(accel['y'])
+        z = _as_f32(accel['z'])
 
         return({'x':x,'y':y,'z':z})
 
@@ -314,8 +410,8 @@ class Session:
         else:
             return 'Empty'
 
-        times = np.array(heart_data['Times'])
-        heart_rate = np.array(heart_data['Heartrate'])
+        times = _as_f32(heart_data['Times'])
+        heart_rate = _as_f32(heart_data['Heartrate'])
 
         return({'times':times,'heart_rate':heart_rate})
 
@@ -323,15 +419,82 @@ class Session:
         fs = '\t Accelerometer sampling frequency: %s samples/s \n' %self.accel_sampling_freq
         duration = '\t Elapsed time of session: %0.2f s \n' %float(self.duration)
 
-        print(self.heart_data)
-        heart_rate = self.heart_data['heart_rate']
+        if isinstance(self.heart_data, str):
+            avg_heart_rate = '\t Average heart rate: %s \n' %self.heart_data
+        else:
+            heart_rate = self.heart_data['heart_rate']
+            avg_heart_rate = '\t Average heart rate: %0.2f bpm \n' %(np.mean(heart_rate))
 
-        avg_heart_rate = '\t Average heart rate: %0.2f bpm \n' %(np.mean(heart_rate))
         return(fs + duration + avg_heart_rate)
 
     def __repr__(self):
         return self.__str__()
 
+def _as_f32(values):
+    return np.fromiter(values,dtype=np.float32,count=len(values))
+
+class _LazySessions(Mapping):
+    """ Read-only mapping from session dates to Sessions that downloads each
+    session the first time it is looked up and keeps it afterwards. .values()
+    and .items() download every session not yet loaded concurrently, before
+    iterating. """
+
+    def __init__(self,user,dates,sessions=None):
+        self._user = user
+        # Dates are kept as dict keys: ordered, with constant time lookups.
+        self._dates = dict.fromkeys(dates)
+        self._sessions = dict(sessions or {})
+
+    def __getitem__(self,date):
+        if date not in self._dates:
+            raise KeyError(date)
+
+        if date not in self._sessions:
+            self._sessions[date] = _get_single(date,self._user)
+        return self._sessions[date]
+
+    def __contains__(self,date):
+        return date in self._dates
+
+    def __iter__(self):
+        return iter(self._dates)
+
+    def __len__(self):
+        return len(self._dates)
+
+    def values(self):
+        self.load_all()
+        return Mapping.values(self)
+
+    def items(self):
+        self.load_all()
+        return Mapping.items(self)
+
+    def load_all(self):
+        """ Downloads every session that has not been loaded yet. """
+
+        missing = [date for date in self._dates if date not in self._sessions]
+        if missing:
+            self._sessions.update(get_session_for(self._user,sessions=missing))
+
+    def durations(self):
+        """ Returns the duration of every session, keyed by date. Durations of
+        sessions that have not been loaded are downloaded concurrently from
+        their shallow Duration key rather than with the whole session. """
+
+        durations = dict((date,session.duration)
+                         for date,session in self._sessions.items())
+        missing = [date for date in self._dates if date not in durations]
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            downloaded = executor.map(self._download_duration_of,missing)
+            durations.update(zip(missing,downloaded))
+        return durations
+
+    def _download_duration_of(self,date):
+        url = base_url + self._user + '/' + date + '/Duration.json'
+        return download_json_data_from(url)
+
 
 def get_session_for(user,sessions='all'):
     """ optional sessions parameter should be a string containing the name of
@@ -345,13 +508,14 @@ def get_session_for(user,sessions='all'):
     Results are of type custom class Session. """
 
     if sessions == 'all':
-        sessions = get_session_dates_for(user)
+        user_data = _download_user(user)
+        user_data.pop('MetaData',None)
+        return _sessions_from(user_data)
 
     if type(sessions) is list:
-        user_data = {}
-        for session in sessions:
-            user_data[session] = _get_single(session,user)
-        return user_data
+        with ThreadPoolExecutor(max_workers) as executor:
+            user_data = executor.map(lambda s: (s, _get_single(s,user)), sessions)
+            return dict(user_data)
 
     else:
         return(_get_single(sessions,user))
@@ -362,15 +526,30 @@ def get_session_dates_for(user,readable=False):
     returned: ddMMyyhhmmss. The later form must be used in order to be passed
     into get_session_for(). """
 
+    return list(_download_session_dates_for(user,readable))
+
+@functools.lru_cache(maxsize=None)
+def _download_session_dates_for(user,readable):
+    # Cached as a tuple so callers cannot change the cached dates.
     url = base_url + user + '.json?shallow=true'
     user_dates = download_json_data_from(url)
 
     del user_dates['MetaData']
 
     if readable:
-        return _lex_multiple(user_dates)
+        return tuple(_lex_multiple(user_dates))
     else:
-        return _date_sort(user_dates.keys())
+        return tuple(_date_sort(user_dates.keys()))
+
+def _download_user(user):
+    """ Downloads everything stored for user, sessions and MetaData, in one
+    request. """
+
+    url = base_url + user + '.json'
+    return download_json_data_from(url)
+
+def _sessions_from(user_data):
+    return dict((date,Session(session)) for date,session in user_data.items())
 
 def _get_single(session,for_user):
         url = base_url + for_user + '/' + session + '.json'
@@ -378,27 +557,19 @@ def _get_single(session,for_user):
 
 
 def _lex_multiple(dates):
-    dates = dates.keys()
-    lexed_dates = []
-    for date in dates:
-        lexed_date = _lex(date)
-        lexed_dates.append(lexed_date)
-    return _date_sort(lexed_dates)
+    return [_lex(date) for date in _date_sort(dates.keys())]
 
 def _lex(date):
-        characters = ['.','.',' ',':',':','']
-        lexed_date = ""
-        for iChar in range(0,len(characters)):
-            iDate = iChar*2
-            lexed_date += (date[iDate:(iDate+2)] + characters[iChar])
-        return(lexed_date)
+    return('%s.%s.%s %s:%s:%s' %(date[0:2],date[2:4],date[4:6],
+                                 date[6:8],date[8:10],date[10:12]))
 
 def _date_sort(dates):
     """ Sorts a list of dates in increasing order by year, month, day, hour,
     minute, then second i.e most recent last. """
 
-    dates.sort(key=lambda x: (x[4:6],x[2:4],x[0:2],x[6:8],x[8:10],x[10:12]))
-    return(dates)
+    dates = list(dates)
+    keys = [int(date[4:6] + date[2:4] + date[0:2] + date[6:12]) for date in dates]
+    return([date for key,date in sorted(zip(keys,dates))])
 
 ### Plot ###
 def plot(session):
@@ -408,13 +579,13 @@ def plot(session):
         y = session.accel_data['y']
         z = session.accel_data['z']
 
-        end = float(session.duration)
-        t = _linspace(0,end,len(x))
+        step = float(session.duration)/max(len(x) - 1,1)
+        t = np.arange(len(x),dtype=np.float32)*step
 
         ax = fig.add_subplot(211)
-        plt.plot(t,x,label='X')
-        plt.plot(t,y,label='Y')
-        plt.plot(t,z,label='Z')
+        plt.plot(*downsample(t,x),label='X')
+        plt.plot(*downsample(t,y),label='Y')
+        plt.plot(*downsample(t,z),label='Z')
         ax.set_ylabel('Acceleration (G)')
         ax.set_title('Accelerometer Data')
         plt.legend()
@@ -425,7 +596,7 @@ def plot(session):
         heart_rate = session.heart_data['heart_rate']
         times = session.heart_data['times']
         ax = fig.add_subplot(212, sharex=ax1)
-        plt.plot(times,heart_rate)
+        plt.plot(*downsample(times,heart_rate))
         ax.set_xlabel('time (s)')
         ax.set_ylabel('Heart rate (BPM)')
         ax.set_title('Heart Rate')
@@ -435,8 +606,14 @@ def plot(session):
     ax1 = plot_accel()
     ax2 = plot_heart_rate()
 
+def downsample(t,signal):
+    """ Reduces signals longer than max_plot_points to plot_points points with
+    MinMaxLTTB, which keeps local extrema such as movement spikes, so long
+    sessions render quickly without visibly changing the trace. Returns the
+    pair (t, signal), ready to be unpacked into plt.plot(). """
+
+    if len(signal) <= max_plot_points:
+        return(t,signal)
 
-def _linspace(start,end,stepsize):
-    start = float(start); end = float(end); length = float(stepsize)
-    out = np.linspace(start,end,length)
-    return(out)
+    indices = MinMaxLTTBDownsampler().downsample(t,signal,n_out=plot_points)
+    return(t[indices],signal[indices])
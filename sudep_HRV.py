@@ -10,6 +10,7 @@ Lorenz plots approximations. """
 
 import numpy as np
 import matplotlib.pyplot as plt
+from numba import njit
 import math
 
 # From piskorski2007geometry.
@@ -24,11 +25,18 @@ def CSI(heart_data,num_points=50,from_watch=True):
         beats = heart_data
 
     SD1,SD2 = SD(beats,num_points=num_points)
+    _csi_kernel(SD1,SD2)
+    return(SD2)
 
-    SD2[SD1 == 0] = 1
-    SD1[SD1 == 0] = 1
+@njit(fastmath=True, cache=True)
+def _csi_kernel(SD1, SD2):
+    """ Overwrites SD2 with SD2/SD1, using 1 wherever SD1 is 0. """
 
-    return(SD2/SD1)
+    for i in range(len(SD2)):
+        if SD1[i] == 0:
+            SD2[i] = 1.0
+        else:
+            SD2[i] = SD2[i]/SD1[i]
 
 
 def SD(beats,num_points=50):
@@ -38,34 +46,46 @@ def SD(beats,num_points=50):
     Where n = len(heartrate_signal) - num_points + 1 and heartrate_signal is
     a vector of beat intervals. '''
 
-    signal_length = len(beats)
-    n = signal_length - num_points + 1
-
-    indices = np.sum(np.mgrid[0:n,0:num_points],axis=0)
-    windowed_beats = beats[indices]
-
-    x = windowed_beats[0:n-1]; y = windowed_beats[1:n]
-
-    def means(x,y):
-        meanx = np.mean(x,axis=1)
-        meany = np.mean(y,axis=1)
-        return(meanx,meany)
-
-    meanx,meany = means(x,y)
-
-    def SD1():
-        mean = np.transpose([meany - meanx])
-
-        SD1 = np.std((x - y) + mean,axis=1)/(2.0**0.5)
-        return(SD1)
-
-    def SD2():
-        mean = np.transpose([meanx + meany])
-
-        SD2 = np.std((x + y) - mean,axis=1)/(2.0**0.5)
-        return(SD2)
-
-    return(SD1(),SD2())
+    n = len(beats) - num_points
+
+    SD1 = np.zeros(max(n,0)); SD2 = np.zeros(max(n,0))
+    _sd_kernel(beats,num_points,SD1,SD2)
+    return(SD1,SD2)
+
+@njit(fastmath=True, cache=True)
+def _sd_kernel(beats, w, SD1, SD2):
+    """ Fills SD1 and SD2 in one pass over beats by sliding running sums of
+    x - y and x + y across the windows. x + y is offset by its first value to
+    keep the sums small. """
+
+    n = len(SD1)
+    if n == 0:
+        return
+
+    shift = beats[0] + beats[1]
+    sum_diff = 0.0; sum_diff_sq = 0.0
+    sum_sum = 0.0; sum_sum_sq = 0.0
+    for k in range(w):
+        diff = beats[k] - beats[k+1]
+        total = beats[k] + beats[k+1] - shift
+        sum_diff += diff; sum_diff_sq += diff*diff
+        sum_sum += total; sum_sum_sq += total*total
+
+    for i in range(n):
+        var_diff = max(sum_diff_sq/w - (sum_diff/w)**2, 0.0)
+        var_sum = max(sum_sum_sq/w - (sum_sum/w)**2, 0.0)
+        SD1[i] = math.sqrt(var_diff/2.0)
+        SD2[i] = math.sqrt(var_sum/2.0)
+
+        if i + 1 < n:
+            old_diff = beats[i] - beats[i+1]
+            old_total = beats[i] + beats[i+1] - shift
+            new_diff = beats[i+w] - beats[i+w+1]
+            new_total = beats[i+w] + beats[i+w+1] - shift
+            sum_diff += new_diff - old_diff
+            sum_diff_sq += new_diff*new_diff - old_diff*old_diff
+            sum_sum += new_total - old_total
+            sum_sum_sq += new_total*new_total - old_total*old_total
 
 def HRV_plots(session,CSI_num=50):
     """ plots CSI_50, heartrate of time, and a lorenz plot. Input should be
@@ -93,8 +113,7 @@ def plot_CSI(times, beats, n, ax=None):
     if ax is None:
         ax = plt.gca()
 
-    SD1,SD2 = SD(beats,num_points=n)
-    ax.plot(times[n:],SD2/SD1)
+    ax.plot(times[n:],CSI(beats,num_points=n,from_watch=False))
     ax.set_xlabel('time(s)')
     ax.set_ylabel(r'CSI$_{%i}$' %n)
     return ax
@@ -2,9 +2,15 @@ from sudep import *
 import sudep_HRV
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.stats import laplace
+from scipy.stats import laplace, erlang
+from scipy.ndimage import uniform_filter1d
+from numba import njit
 import math
 
+# Merge near-collinear path segments and draw long paths in chunks.
+plt.rcParams['path.simplify_threshold'] = 1.0
+plt.rcParams['agg.path.chunksize'] = 10000
+
 ### Select sessions and plot types. ###
 use_long_sessions = True
 do_detect = True
@@ -51,16 +57,18 @@ def unpack_accel_from(session):
     return(x,y,z)
 
 def moving_average(signal,n):
-    indices = np.mgrid[0:int(math.floor(len(signal[0])/n)),0:n]
-    indices = np.transpose(np.sum(indices,axis=0))
-    signal = np.mean(signal[0:,indices],axis=1)
-    return(signal)
+    # uniform_filter1d centres each window, so shifting by n//2 gives the
+    # average of the n points starting at each index.
+    num_windows = len(signal[0])//n
+    signal = uniform_filter1d(signal,size=n,axis=-1,mode='nearest')
+    return(signal[:,n//2:n//2 + num_windows])
 
 def all_dimesions_hist(data,axes,names):
-    for i in xrange(len(names)):
+    for i in range(len(names)):
         signal = data[i]; ax = axes[i]; name = names[i]
 
-        lim = np.percentile(signal,99)
+        k = int(0.99*(len(signal) - 1))
+        lim = np.partition(signal,k)[k]
         bins = np.linspace(-lim,lim,40)
 
         accel_diff_hist(signal,ax,name,lim,bins)
@@ -79,10 +87,26 @@ def plot_laplace_dist(signal,ax,lim,bins):
     ax.plot(bins,laplace.pdf(bins,mu,b),'r--')
 
 def dist_stats(signal,lim):
-    stat_signal = signal[abs(signal) < lim]
-    mu = np.mean(stat_signal)
-    sigma = np.std(stat_signal,ddof=1)
-    return(mu,sigma)
+    return(_clipped_mean_std(signal,lim))
+
+@njit(fastmath=True, cache=True)
+def _clipped_mean_std(signal, lim):
+    """ Mean and sample standard deviation of the values of signal with
+    magnitude below lim, accumulated with Welford's method. """
+
+    n = 0; mean = 0.0; m2 = 0.0
+    for value in signal:
+        if abs(value) < lim:
+            n += 1
+            delta = value - mean
+            mean += delta/n
+            m2 += delta*(value - mean)
+
+    # Match np.mean/np.std(ddof=1): NaN when there are too few values.
+    if n < 2:
+        return((mean if n else np.nan), np.nan)
+
+    return(mean, math.sqrt(m2/(n - 1)))
 
 def plot_beat_hist(session):
     """ Compares beat-interval histogram to Erlang distribution. Requires long
@@ -104,8 +128,7 @@ def plot_beat_hist(session):
 def plot_erlang(ax,mu):
     x = np.linspace(0,1600,1000)
 
-    erlang = lambda x,k,mu: np.multiply(np.power(x,k-1),np.exp(-x/mu))/((mu**k)*math.factorial(k-1))
-    ax.plot(x,2.8*erlang(x,55,mu/50),'r--')
+    ax.plot(x,2.8*erlang.pdf(x,55,scale=mu/50.0),'r--')
 
 def variance_statistics(signal,window):
     var = windowed_sample_variance(signal,window)
@@ -118,11 +141,31 @@ def variance_statistics(signal,window):
     return(max_var,min_var,mean_var,var_var)
 
 def windowed_sample_variance(signal,window):
-    indices = np.mgrid[0:int(len(signal) - window + 1),0:window]
-    indices = np.transpose(np.sum(indices,axis=0))
-    var = np.var(np.diff(signal[indices]),axis=0)
+    diff = np.diff(signal)
+    var = np.zeros(max(len(diff) - window + 1,0))
+    _windowed_variance(diff,window,var)
     return(var)
 
+@njit(fastmath=True, cache=True)
+def _windowed_variance(signal, window, var):
+    """ Fills var with the variance of each window of signal, sliding a
+    running sum and sum of squares along the signal in a single pass. """
+
+    if len(var) == 0:
+        return
+
+    total = 0.0; total_sq = 0.0
+    for i in range(window):
+        total += signal[i]; total_sq += signal[i]*signal[i]
+
+    for i in range(len(var)):
+        var[i] = max(total_sq/window - (total/window)**2, 0.0)
+
+        if i + 1 < len(var):
+            old = signal[i]; new = signal[i+window]
+            total += new - old
+            total_sq += new*new - old*old
+
 def plot_accel_detection(session,num_seconds = 5):
     (x,y,z) = unpack_accel_from(session)
     freq = session.accel_sampling_freq
@@ -130,9 +173,10 @@ def plot_accel_detection(session,num_seconds = 5):
     num_points = num_seconds*freq
 
     plt.figure()
-    plt.plot(time,x,label='x')
-    plt.plot(time,y,'r',label='y')
-    plt.plot(time,z,'g',label='z')
+    trace_style = {'antialiased':False,'rasterized':True}
+    plt.plot(*downsample(time,x),label='x',**trace_style)
+    plt.plot(*downsample(time,y),'r',label='y',**trace_style)
+    plt.plot(*downsample(time,z),'g',label='z',**trace_style)
 
     mark_high_var(time,x,num_points)
     mark_high_var(time,y,num_points)
@@ -152,7 +196,8 @@ def mark_high_var(time, signal, window):
     buffer = np.zeros(window-1)
     is_above_thresh = np.append(buffer,find_high_variance(var)).astype(bool)
 
-    plt.plot(time[is_above_thresh],signal[is_above_thresh],'k.')
+    plt.scatter(time[is_above_thresh],signal[is_above_thresh],s=4,c='k',
+                rasterized=True)
 
 def find_high_variance(var, THRESH=1):
     return(var > THRESH)